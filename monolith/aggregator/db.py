@@ -1,28 +1,41 @@
+from collections import defaultdict
 from contextlib import contextmanager
 import datetime
+from itertools import izip
+import zlib
 
-from sqlalchemy import Column, Date, Integer, LargeBinary, String
+from sqlalchemy import Column, Date, Index, Integer, LargeBinary, String
 from sqlalchemy import create_engine
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.sql import text
+from sqlalchemy.sql.expression import Insert
 from sqlalchemy.types import BINARY
 
 from monolith.aggregator.plugins import Plugin
-from monolith.aggregator.uid import urlsafe_uid
+from monolith.aggregator.uid import content_uid, urlsafe_uids
 from monolith.aggregator.util import date_range, json_dumps, json_loads
 
 _Model = declarative_base()
 
+# first byte of the compressed values. The raw JSON values of the rows
+# written without compression start with '{'
+ZLIB_HEADER = '\x01'
+
 
 class Record(_Model):
     __tablename__ = 'record'
-    __table_args__ = {
-        'mysql_engine': 'InnoDB',
-        'mysql_charset': 'utf8',
-        'mysql_row_format': 'compressed',
-        'mysql_key_block_size': '4',
-    }
+    __table_args__ = (
+        # used to read the records in (date, id) order, chunk by chunk
+        Index('record_date_id', 'date', 'id'),
+        {
+            'mysql_engine': 'InnoDB',
+            'mysql_charset': 'utf8',
+            'mysql_row_format': 'compressed',
+            'mysql_key_block_size': '4',
+        },
+    )
 
     id = Column(BINARY(24), primary_key=True)
     date = Column(Date, nullable=False)
@@ -33,10 +46,13 @@ class Record(_Model):
 
 class Transaction(_Model):
     __tablename__ = 'monolith_transaction'
-    __table_args__ = {
-        'mysql_engine': 'InnoDB',
-        'mysql_charset': 'utf8',
-    }
+    __table_args__ = (
+        Index('transaction_source_date', 'source', 'date', unique=True),
+        {
+            'mysql_engine': 'InnoDB',
+            'mysql_charset': 'utf8',
+        },
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     date = Column(Date, nullable=False)
@@ -47,6 +63,23 @@ record_table = Record.__table__
 transaction_table = Transaction.__table__
 
 
+class _Upsert(Insert):
+    """An INSERT overwriting the value of the records already stored
+    under the same id.
+    """
+
+
+@compiles(_Upsert)
+def _compile_upsert(insert, compiler, **kw):
+    return compiler.visit_insert(insert, **kw)
+
+
+@compiles(_Upsert, 'mysql')
+def _compile_mysql_upsert(insert, compiler, **kw):
+    sql = compiler.visit_insert(insert, **kw)
+    return sql + ' ON DUPLICATE KEY UPDATE value = VALUES(value)'
+
+
 def get_engine(sqluri, pool_size=100, pool_recycle=60, pool_timeout=30):
     extras = {}
     if not sqluri.startswith('sqlite'):
@@ -58,10 +91,21 @@ def get_engine(sqluri, pool_size=100, pool_recycle=60, pool_timeout=30):
 
 
 class Database(Plugin):
+    # all the batches of a phase share one session and connection
+    max_inflight = 1
 
     def __init__(self, **options):
         Plugin.__init__(self, **options)
         self.sqluri = options['database']
+        self.chunk_size = int(options.get('chunk_size', 1000))
+        # 'random' or 'content' ids
+        self.uid = options.get('uid', 'random')
+        if self.uid not in ('random', 'content'):
+            raise ValueError('Unknown uid mode %r' % self.uid)
+        # 'none' or 'zlib' compression of the stored values
+        self.compress = options.get('compress', 'none')
+        if self.compress not in ('none', 'zlib'):
+            raise ValueError('Unknown compression %r' % self.compress)
         self.engine = get_engine(self.sqluri)
         self.mysql = 'mysql' in self.engine.driver
         self.session_factory = sessionmaker(bind=self.engine, autocommit=False,
@@ -112,19 +156,69 @@ class Database(Plugin):
     def in_transaction(self):
         return self._transaction is not None
 
+    def _content_uid(self, source_id, date, type, item, dimensions):
+        # a missing dimension differs from a dimension set to None
+        values = [(name, item[name]) for name in sorted(dimensions)
+                  if name in item]
+        return content_uid(date, source_id, type, values)
+
     def inject(self, batch):
+        # plain rows, no ORM object is created per record
+        records = []
+        by_content = {}
+        by_date = defaultdict(list)
+        for source_id, item in batch:
+            item = dict(item)
+            date = item.pop('_date')
+            type = item.pop('_type')
+            dimensions = item.pop('_dimensions', None)
+            value = json_dumps(item)
+            if self.compress == 'zlib':
+                value = ZLIB_HEADER + zlib.compress(value)
+            record = {'date': date, 'type': type, 'source_id': source_id,
+                      'value': value}
+            if self.uid == 'content' and dimensions is not None:
+                # the last version of a record wins
+                record['id'] = self._content_uid(source_id, date, type, item,
+                                                 dimensions)
+                by_content[record['id']] = record
+            else:
+                # random ids, also for the lines without dimensions,
+                # as their measured values can't be part of an id.
+                # The ids only depend on the day
+                records.append(record)
+                if isinstance(date, datetime.datetime):
+                    by_date[date.date()].append(record)
+                else:
+                    by_date[date].append(record)
+
+        records.extend(by_content.values())
+        if not records:
+            return
+
+        # one call per date to generate the ids
+        for date, day_records in by_date.items():
+            for record, id_ in izip(day_records,
+                                    urlsafe_uids(len(day_records), date)):
+                record['id'] = id_
+
         with self.transaction() as session:
-            records = []
-            for source_id, item in batch:
-                item = dict(item)
-                date = item.pop('_date')
-                type = item.pop('_type')
-                records.append(
-                    Record(id=urlsafe_uid(date),
-                           date=date, type=type,
-                           source_id=source_id,
-                           value=json_dumps(item)))
-            session.add_all(records)
+            # the records of a previous run are overwritten in place
+            # when using content ids
+            content = self.uid == 'content'
+            if self.mysql:
+                # a single multi-row INSERT ... VALUES statement
+                if content:
+                    query = _Upsert(record_table).values(records)
+                else:
+                    query = record_table.insert().values(records)
+                session.execute(query)
+            else:
+                # one executemany call
+                query = record_table.insert()
+                if content:
+                    query = query.prefix_with('OR REPLACE')
+                session.execute(query, records)
 
     def _check(self, data):
         data = dict(data)
@@ -132,6 +226,8 @@ class Database(Plugin):
         value = data['value']
         if isinstance(value, buffer):
             value = str(value)
+        if value[:1] == ZLIB_HEADER:
+            value = zlib.decompress(value[1:])
         data.update(json_loads(value))
         del data['value']
 
@@ -151,13 +247,39 @@ class Database(Plugin):
         return data
 
     def extract(self, start_date, end_date):
-        query = text(
+        """Reads the records in chunks of *chunk_size* lines.
+
+        Each chunk starts right after the last (date, id) of the previous
+        one, so the memory stays constant whatever the date range is and
+        the first lines come back right away.
+        """
+        first = text(
             'select id AS _id, type AS _type, source_id, date, value '
-            'from record where date BETWEEN :start_date and :end_date'
+            'from record where date BETWEEN :start_date and :end_date '
+            'order by date, id limit :limit'
         )
-        data = self.engine.execute(query, start_date=start_date,
-                                   end_date=end_date)
-        return (self._check(line) for line in data)
+        next_ = text(
+            'select id AS _id, type AS _type, source_id, date, value '
+            'from record where date BETWEEN :start_date and :end_date '
+            'and (date > :last_date or (date = :last_date and id > :last_id)) '
+            'order by date, id limit :limit'
+        )
+        params = {'start_date': start_date, 'end_date': end_date,
+                  'limit': self.chunk_size}
+        query = first
+
+        while True:
+            lines = self.engine.execute(query, **params).fetchall()
+            for line in lines:
+                yield self._check(line)
+
+            if len(lines) < self.chunk_size:
+                break
+
+            last = lines[-1]
+            params['last_date'] = last['date']
+            params['last_id'] = last['_id']
+            query = next_
 
     def clear(self, start_date, end_date, source_ids):
         count = 0
@@ -170,23 +292,40 @@ class Database(Plugin):
         return count
 
     def add_entry(self, sources, start_date, end_date=None, num=0):
+        if end_date is None:
+            drange = (start_date,)
+        else:
+            drange = date_range(start_date, end_date)
+
+        entries = [{'source': source.get_id(), 'date': date}
+                   for date in drange for source in sources]
+        if not entries:
+            return
+
         with self.transaction() as session:
-            if end_date is None:
-                drange = (start_date,)
+            # days already logged for a source are skipped
+            if self.mysql:
+                query = transaction_table.insert().prefix_with('IGNORE')
+                session.execute(query.values(entries))
             else:
-                drange = date_range(start_date, end_date)
+                query = transaction_table.insert().prefix_with('OR IGNORE')
+                session.execute(query, entries)
 
-            for date in drange:
-                for source in sources:
-                    session.add(Transaction(source=source.get_id(),
-                                            date=date))
+    def get_done(self, sources, start_date, end_date):
+        """Returns the set of (source id, date) already done for all the
+        *sources* between the two dates, using a single query.
+        """
+        source_ids = [source.get_id() for source in sources]
+        if not source_ids:
+            return set()
 
-    def exists(self, source, start_date, end_date):
-        count = 0
         with self.transaction() as session:
-            query = session.query(Transaction)
-            query = query.filter(Transaction.source == source.get_id())
+            query = session.query(Transaction.source, Transaction.date)
+            query = query.filter(Transaction.source.in_(source_ids))
             query = query.filter(Transaction.date >= start_date)
             query = query.filter(Transaction.date <= end_date)
-            count = query.count()
-        return count > 0
+            done = set(query.distinct())
+        return done
+
+    def exists(self, source, start_date, end_date):
+        return len(self.get_done([source], start_date, end_date)) > 0
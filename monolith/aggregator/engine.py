@@ -1,55 +1,135 @@
+from collections import defaultdict
 from functools import partial
+import time
 
-import gevent
-from gevent.pool import Group
-from gevent.queue import Queue
+from gevent import GreenletExit
+from gevent.event import Event
+from gevent.pool import Group, Pool
+from gevent.queue import Empty, Queue
 
 from monolith.aggregator import exception, logger
+from monolith.aggregator.util import missing_date_ranges
+
+
+def _bucket(size):
+    # smallest power of two holding *size*
+    bucket = 1
+    while bucket < size:
+        bucket *= 2
+    return bucket
 
 
 class Engine(object):
 
     def __init__(self, sequence, database, phase_hook=None, batch_size=100,
-                 force=False, retries=3):
+                 force=False, retries=3, queue_size=None, max_latency=1.0,
+                 inflight=1, clear=True):
         self.sequence = sequence
         self.database = database
-        self.queue = Queue()
+        # when bounded, sources block on a full queue until the targets
+        # catch up, so memory stays flat whatever the date range is
+        self.queue_size = queue_size or None
+        self.queue = Queue(maxsize=self.queue_size)
         self.phase_hook = phase_hook
         self.batch_size = batch_size
+        # maximum number of seconds an item waits in a partial batch
+        self.max_latency = max_latency
+        # default number of batches being written at once per target
+        self.inflight = inflight
         self.force = force
+        # clear the targets before forcing a run. Not needed when the
+        # targets overwrite the records in place
+        self.clear = clear
         self.retries = retries
         self.errors = []
-
-    def _push_to_target(self, targets):
-        """Get a batch of elements from the queue, and push it to the targets.
-
-        This function returns True if it proceeded all the elements in
-        the queue, and there isn't anything more to read.
+        self.stats = {}
+        # number of sources still feeding the queue, and the event
+        # waking up the collector when an item or a completion comes
+        self._running = 0
+        self._done_sources = []
+        self._wakeup = Event()
+
+    def _get_pools(self, targets):
+        """Return a (target, pool) list, one pool per target.
+
+        The size of the pool is the number of batches that can be written
+        at once in the target. It can be overriden with the **inflight**
+        option of the target section, and is capped by the
+        **max_inflight** attribute of the target.
+        """
+        pools = []
+        for plugin in targets:
+            options = getattr(plugin, 'options', {})
+            size = int(options.get('inflight', self.inflight))
+            max_inflight = getattr(plugin, 'max_inflight', None)
+            if max_inflight is not None:
+                size = min(size, max_inflight)
+            pools.append((plugin, Pool(size)))
+        return pools
+
+    def _push_to_target(self, pools, batch):
+        """Push a batch of elements to the targets.
+
+        The batch is handed to each target as soon as it has a free slot
+        in its pool, so the next batch is collected while the previous
+        ones are still being written.
+        """
+        self.stats['batches'][_bucket(len(batch))] += 1
+        for plugin, pool in pools:
+            green = pool.spawn(self._put_data, plugin, batch)
+            green.rawlink(partial(self._check_error, exception.InjectError,
+                                  plugin))
+
+    def _collect(self, pools):
+        """Collect batches from the queue and push them to the targets.
+
+        A batch is pushed as soon as it reaches *batch_size* items, or when
+        its first item has been waiting for *max_latency* seconds. In
+        between, the collector sleeps until a source puts a new item in
+        the queue or finishes.
+
+        Batches are filled across sources. The function returns once all
+        the sources are done and the queue is empty.
         """
-        if self.queue.empty():
-            return 0    # nothing
-
         batch = []
-        pushed = 0
-
-        # collecting a batch
-        while len(batch) < self.batch_size:
-            item = self.queue.get()
-            if item == 'END':
-                pushed += 1  # the 'END' item
-                break
-            batch.append(item)
-
-        if len(batch) != 0:
-            greenlets = Group()
-            for plugin in targets:
-                green = greenlets.spawn(self._put_data, plugin, batch)
-                green.link_exception(partial(self._error,
-                                             exception.InjectError, plugin))
-            greenlets.join()
-            pushed += len(batch)
+        deadline = None
+
+        while True:
+            # let's see if we have some errors
+            if len(self.errors) > 0:
+                # yeah! we need to rollback
+                # XXX later we'll do a source-by-source rollback
+                raise exception.RunError(self.errors)
 
-        return pushed
+            try:
+                batch.append(self.queue.get_nowait())
+            except Empty:
+                if self._running == 0:
+                    break
+
+                if deadline is None:
+                    timeout = None
+                else:
+                    timeout = max(deadline - time.time(), 0)
+
+                self._wakeup.clear()
+                if not self._wakeup.wait(timeout):
+                    # nothing came before the deadline
+                    self._push_to_target(pools, batch)
+                    batch = []
+                    deadline = None
+                continue
+
+            if deadline is None:
+                deadline = time.time() + self.max_latency
+
+            if len(batch) >= self.batch_size or time.time() >= deadline:
+                self._push_to_target(pools, batch)
+                batch = []
+                deadline = None
+
+        if batch:
+            self._push_to_target(pools, batch)
 
     #
     # transaction managment
@@ -70,19 +150,38 @@ class Engine(object):
     def _put_data(self, plugin, data):
         return plugin.inject(data)
 
-    def _get_data(self, plugin, start_date, end_date):
-        try:
+    def _put(self, item):
+        if self.queue.full():
+            self.stats['queue_full'] += 1
+        self.queue.put(item)
+        self._wakeup.set()
+        size = self.queue.qsize()
+        if size > self.stats['queue_hwm']:
+            self.stats['queue_hwm'] = size
+
+    def _get_data(self, plugin, ranges):
+        for start_date, end_date in ranges:
             for item in plugin.extract(start_date, end_date):
-                self.queue.put((plugin.get_id(), item))
-        finally:
-            self.queue.put('END')
+                self._put((plugin.get_id(), item))
 
-    def _log_transaction(self, source, start_date, end_date, greenlet):
-        self.database.add_entry([source], start_date, end_date)
+    def _source_done(self, source, ranges, greenlet):
+        self._running -= 1
+        self._wakeup.set()
+        self._check_error(exception.ExtractError, source, greenlet)
+        if (greenlet.successful() and
+                not isinstance(greenlet.value, GreenletExit)):
+            # logged by _run_phase once every target is done
+            self._done_sources.append((source, ranges))
 
     def _error(self, exception, plugin, greenlet):
         self.errors.append((exception, plugin, greenlet))
 
+    def _check_error(self, exception, plugin, greenlet):
+        # raw links are called as soon as the greenlet dies, so errors
+        # are known before the phase is committed
+        if not greenlet.successful():
+            self._error(exception, plugin, greenlet)
+
     def _run_phase(self, phase, start_date, end_date):
         phase, sources, targets = phase
         logger.info('Running phase %r' % phase)
@@ -90,42 +189,68 @@ class Engine(object):
 
         self._start_transactions(targets)
         self.database.start_transaction()
+        greenlets = Group()
+        pools = self._get_pools(targets)
         try:
-            greenlets = Group()
+            # a single query tells which days each source already did
+            done = defaultdict(set)
+            for source_id, date in self.database.get_done(sources,
+                                                          start_date,
+                                                          end_date):
+                done[source_id].add(date)
+
             # each callable will push its result in the queue
             for source in sources:
-                exists = self.database.exists(source, start_date, end_date)
-                if exists and not self.force:
+                if self.force:
+                    ranges = [(start_date, end_date)]
+                else:
+                    ranges = missing_date_ranges(start_date, end_date,
+                                                 done[source.get_id()])
+
+                if not ranges:
                     logger.info('Already done: %s, %s to %s' % (
                         source.get_id(), start_date, end_date))
                     continue
+                elif ranges != [(start_date, end_date)]:
+                    logger.info('Partially done: %s, extracting %s' % (
+                        source.get_id(),
+                        ', '.join(['%s to %s' % range_
+                                   for range_ in ranges])))
 
-                green = greenlets.spawn(self._get_data, source,
-                                        start_date, end_date)
-                green.link_value(partial(self._log_transaction, source,
-                                         start_date, end_date))
-                green.link_exception(partial(self._error, ExtractError,
-                                             source))
+                green = greenlets.spawn(self._get_data, source, ranges)
+                green.rawlink(partial(self._source_done, source, ranges))
+                self._running += 1
 
             # looking at the queue
-            pushed = 0
+            self._collect(pools)
+
+            # waiting for the batches still being written, and for
+            # the last sources that may still be finishing
+            for plugin, pool in pools:
+                pool.join()
+            greenlets.join()
+            if len(self.errors) > 0:
+                raise exception.RunError(self.errors)
 
-            while len(greenlets) > 0 or self.queue.qsize() > 0:
-                gevent.sleep(0)
-                pushed += self._push_to_target(targets)
-                # let's see if we have some errors
-                if len(self.errors) > 0:
-                    # yeah! we need to rollback
-                    # XXX later we'll do a source-by-source rollback
-                    raise exception.RunError(self.errors)
+            # the transaction session is only used from here, never
+            # from a greenlet
+            for source, ranges in self._done_sources:
+                for range_start, range_end in ranges:
+                    self.database.add_entry([source], range_start, range_end)
 
         except Exception:
+            # sources may be blocked on a full queue
+            greenlets.kill()
+            for plugin, pool in pools:
+                pool.kill()
             self._rollback_transactions(targets)
             self.database.rollback_transaction()
             raise
         else:
             self._commit_transactions(targets)
             self.database.commit_transaction()
+        finally:
+            self._log_stats(phase)
 
     def _clear(self, start_date, end_date):
         source_ids = set()
@@ -163,13 +288,29 @@ class Engine(object):
 
     def _reset_counters(self):
         self.errors = []
+        self.stats = {'queue_hwm': 0, 'queue_full': 0,
+                      'batches': defaultdict(int)}
+        self._running = 0
+        self._done_sources = []
+
+    def _log_stats(self, phase):
+        logger.info('Phase %r queue high-water mark: %d/%s, blocked puts: %d'
+                    % (phase, self.stats['queue_hwm'],
+                       self.queue_size or 'unbounded',
+                       self.stats['queue_full']))
+        batches = sorted(self.stats['batches'].items())
+        histogram = ', '.join(['<=%d: %d' % (size, count)
+                               for size, count in batches])
+        logger.info('Phase %r pushed %d batches, sizes: %s'
+                    % (phase, sum([count for size, count in batches]),
+                       histogram or 'none'))
 
     def run(self, start_date, end_date, purge_only=False):
         self._reset_counters()
 
         if not purge_only:
             # overwrite / clear data
-            if self.force:
+            if self.force and self.clear:
                 self._retry(self._clear, start_date, end_date)
 
             for phase in self.sequence:
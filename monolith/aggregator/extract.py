@@ -1,12 +1,13 @@
 import os
 import argparse
 from ConfigParser import ConfigParser, NoOptionError
+import multiprocessing
 import sys
 from datetime import datetime
 
 from monolith.aggregator import __version__, logger
 from monolith.aggregator.util import (configure_logger, LOG_LEVELS,
-                                      word2daterange)
+                                      split_date_range, word2daterange)
 from monolith.aggregator.db import Database
 from monolith.aggregator.sequence import Sequence
 from monolith.aggregator.engine import Engine
@@ -16,20 +17,26 @@ def _mkdate(datestring):
     return datetime.strptime(datestring, '%Y-%m-%d').date()
 
 
-def extract(config, start_date, end_date, sequence=None, batch_size=None,
-            force=False, purge_only=False, retries=3):
-    """Reads the configuration file and does the job.
+def _load(config, sequence=None):
+    """Parses the configuration file and builds the sequence and
+    the monolith database.
     """
     defaults = {'here': os.path.abspath(os.path.dirname(config))}
     parser = ConfigParser(defaults=defaults)
     parser.read(config)
 
+    # the HTTP connections shared by the plugins. Imported here, so
+    # main() patches the sockets before requests is loaded
+    from monolith.aggregator import httppool
+    try:
+        http_pool_size = parser.getint('monolith', 'http_pool_size')
+    except NoOptionError:
+        http_pool_size = None
     try:
-        batch_size = parser.get('monolith', 'batch_size')
+        http_timeout = parser.getfloat('monolith', 'http_timeout')
     except NoOptionError:
-        # using the default value
-        if batch_size is None:
-            batch_size = 100
+        http_timeout = None
+    httppool.configure(http_pool_size, http_timeout)
 
     # creating the sequence
     sequence = Sequence(parser, sequence)
@@ -45,18 +52,119 @@ def extract(config, start_date, end_date, sequence=None, batch_size=None,
             raise ValueError("You need a database option")
 
     database = Database(database=monolith_db)
+    return parser, sequence, database
+
+
+def _get_option(getter, name, value, default=None):
+    """Returns *value*, unless it's None. Falls back to the *name* option
+    of the monolith section read with *getter*, then to *default*.
+    """
+    if value is not None:
+        return value
+    try:
+        return getter('monolith', name)
+    except NoOptionError:
+        return default
+
+
+def extract(config, start_date, end_date, sequence=None, batch_size=None,
+            force=False, purge_only=False, retries=3, queue_size=None,
+            max_latency=None, inflight=None, workers=1, shard='month',
+            clear=None):
+    """Reads the configuration file and does the job.
+
+    When *workers* is more than 1, the date range is split by *shard*
+    and the sub-ranges are run in that many processes.
+    """
+    if workers > 1:
+        return _extract_shards(config, start_date, end_date, workers, shard,
+                               sequence=sequence, batch_size=batch_size,
+                               force=force, purge_only=purge_only,
+                               retries=retries, queue_size=queue_size,
+                               max_latency=max_latency, inflight=inflight,
+                               clear=clear)
+
+    parser, sequence, database = _load(config, sequence)
+
+    # the arguments win over the [monolith] options
+    batch_size = _get_option(parser.getint, 'batch_size', batch_size, 100)
+    queue_size = _get_option(parser.getint, 'queue_size', queue_size)
+    max_latency = _get_option(parser.getfloat, 'max_latency', max_latency,
+                              1.0)
+    inflight = _get_option(parser.getint, 'inflight', inflight, 1)
+    clear = _get_option(parser.getboolean, 'clear', clear, True)
 
     # run the engine
     engine = Engine(sequence, database, batch_size=batch_size, force=force,
-                    retries=retries)
+                    retries=retries, queue_size=queue_size,
+                    max_latency=max_latency, inflight=inflight, clear=clear)
     return engine.run(start_date, end_date, purge_only)
 
 
+def _extract_shard(args):
+    # runs in a worker process
+    config, start_date, end_date, options = args
+    logger.info('Running shard %s to %s' % (start_date, end_date))
+    try:
+        return extract(config, start_date, end_date, **options)
+    except Exception:
+        logger.exception('Shard %s to %s failed' % (start_date, end_date))
+        return 1
+
+
+def _extract_shards(config, start_date, end_date, workers, shard, **options):
+    """Runs :func:`extract` on each shard of the date range, in a pool of
+    *workers* processes.
+
+    Each shard builds its own sequence, plugins and database, and records
+    its days in the transaction log of the shared monolith database.
+    """
+    shards = split_date_range(start_date, end_date, shard)
+    tasks = [(config, start, end, options) for start, end in shards]
+
+    # setting up the plugins once, so the workers don't all try to
+    # create the same tables or templates at the same time
+    _load(config, options.get('sequence'))
+
+    # a fresh process per shard, so plugins and gevent don't carry any
+    # state from one shard to the other
+    pool = multiprocessing.Pool(min(workers, len(tasks)), maxtasksperchild=1)
+    try:
+        results = pool.map(_extract_shard, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    failures = len([res for res in results if res != 0])
+    if failures > 0:
+        logger.error('%d out of %d shards failed' % (failures, len(tasks)))
+        return 1
+    return 0
+
+
 _DATES = ['today', 'yesterday', 'last-week', 'last-month',
           'last-year']
 
 
+def _patch_sockets():
+    # make the network calls of requests, httplib2 and the MySQL
+    # driver cooperative, so the greenlets of the sources, the targets
+    # and the plugins' own pools overlap their I/O. This has to happen
+    # before these libraries are loaded with the plugins, as they keep
+    # references to the ssl functions they import.
+    #
+    # Once patched, a greenlet may yield in the middle of a query, so
+    # a Database session must never be shared by two greenlets: the
+    # batches of a sql target are written one at a time (max_inflight),
+    # the engine reads and logs the done days from the main greenlet,
+    # and the sql source reads through the connection pool
+    from gevent import monkey
+    monkey.patch_socket()
+    monkey.patch_ssl()
+
+
 def main():
+    _patch_sockets()
     parser = argparse.ArgumentParser(description='Monolith Aggregator')
 
     parser.add_argument('--version', action='store_true', default=False,
@@ -81,12 +189,21 @@ def main():
     parser.add_argument('--batch-size', dest='batch_size', default=None,
                         type=int,
                         help='The size of the batch when writing')
+    parser.add_argument('--queue-size', dest='queue_size', default=None,
+                        type=int,
+                        help='Maximum number of items waiting to be '
+                             'written (unbounded by default)')
     parser.add_argument('--force', action='store_true', default=False,
                         help='Forces a run')
     parser.add_argument('--purge-only', action='store_true', default=False,
                         help='Only run the purge of sources.')
     parser.add_argument('--retries', default=3, type=int,
                         help='Number of retries')
+    parser.add_argument('--workers', default=1, type=int,
+                        help='Number of processes running the date range '
+                             'shards')
+    parser.add_argument('--shard', default='month', choices=['day', 'month'],
+                        help='How the date range is split between workers')
     args = parser.parse_args()
 
     if args.version:
@@ -102,7 +219,8 @@ def main():
 
     configure_logger(logger, args.loglevel, args.logoutput)
     res = extract(args.config, start, end, args.sequence, args.batch_size,
-                  args.force, args.purge_only)
+                  args.force, args.purge_only, queue_size=args.queue_size,
+                  workers=args.workers, shard=args.shard)
 
     if res == 0:
         logger.info('SUCCESS')
@@ -0,0 +1,68 @@
+# A pool of HTTP connections shared by all the plugins of the process.
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+
+# default settings, changed with configure()
+_settings = {'pool_size': 10, 'timeout': 60.}
+_adapter = None
+_session = None
+
+
+class PoolAdapter(HTTPAdapter):
+    """An adapter applying a default timeout to every request.
+
+    Connections are kept alive, at most *pool_size* per host.
+    """
+    def __init__(self, pool_size=10, timeout=None, **kwargs):
+        super(PoolAdapter, self).__init__(pool_connections=pool_size,
+                                          pool_maxsize=pool_size, **kwargs)
+        self.timeout = timeout
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        return super(PoolAdapter, self).send(request, timeout=timeout,
+                                             **kwargs)
+
+
+def configure(pool_size=None, timeout=None):
+    """Changes the settings of the pool.
+
+    The sessions created before keep the previous connections.
+    """
+    global _adapter, _session
+    if pool_size is not None:
+        _settings['pool_size'] = pool_size
+    if timeout is not None:
+        _settings['timeout'] = timeout
+    _adapter = _session = None
+
+
+def get_timeout():
+    return _settings['timeout']
+
+
+def get_adapter():
+    global _adapter
+    if _adapter is None:
+        _adapter = PoolAdapter(**_settings)
+    return _adapter
+
+
+def mount(session):
+    """Makes a session use the shared connections, and returns it."""
+    adapter = get_adapter()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """Returns the session shared by the plugins without their own
+    authentication scheme.
+    """
+    global _session
+    if _session is None:
+        _session = mount(Session())
+    return _session
@@ -1,4 +1,8 @@
 class Plugin(object):
+    # maximum number of batches the plugin can inject at once,
+    # whatever the inflight option says. None means no limit
+    max_inflight = None
+
     def __init__(self, **options):
         self.options = options
 
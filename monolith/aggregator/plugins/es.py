@@ -1,10 +1,45 @@
+from calendar import monthrange
 from collections import defaultdict
+from cStringIO import StringIO
+from itertools import izip
 
+import gevent
+from gevent.pool import Pool
 from pyelasticsearch import ElasticSearch
 from pyelasticsearch.client import es_kwargs
-from pyelasticsearch.exceptions import InvalidJsonResponseError
+from pyelasticsearch.exceptions import (ElasticHttpNotFoundError,
+                                        IndexAlreadyExistsError,
+                                        InvalidJsonResponseError)
+from requests.adapters import HTTPAdapter
 
+from monolith.aggregator import logger
 from monolith.aggregator.plugins import Plugin
+from monolith.aggregator.util import asbool, split_date_range, JSONCodec
+
+
+# bulk item errors worth sending the document again
+RETRY_STATUS = (429, 503)
+RETRY_ERRORS = ('EsRejectedExecutionException',
+                'UnavailableShardsException')
+
+
+# action line of a bulk request, completed with the encoded id
+ACTION_LINE = '{"index": {"_id": %s}}\n'
+
+
+def _retryable(item):
+    if item.get('status') in RETRY_STATUS:
+        return True
+    error = item.get('error', '')
+    return any(name in error for name in RETRY_ERRORS)
+
+
+def _index_error(doc, error):
+    msg = 'Could not index %s' % str(doc)
+    msg += '\nES Error:\n'
+    msg += error
+    msg += '\n The data may have been partially imported.'
+    return msg
 
 
 class ExtendedClient(ElasticSearch):
@@ -12,6 +47,15 @@ class ExtendedClient(ElasticSearch):
     API's. These should be merged upstream.
     """
 
+    def __init__(self, *args, **kw):
+        super(ExtendedClient, self).__init__(*args, **kw)
+        # reuse a single encoder for all the requests
+        self._codec = JSONCodec(encoder=self.json_encoder, default=None,
+                                use_decimal=True)
+
+    def _encode_json(self, value):
+        return self._codec.encode(value)
+
     @es_kwargs()
     def create_template(self, name, settings, query_params=None):
         """
@@ -61,13 +105,16 @@ class ExtendedClient(ElasticSearch):
 
 class ESSetup(object):
 
+    refresh_interval = "10s"
+    number_of_replicas = 1
+
     def __init__(self, client):
         self.client = client
 
     def _default_settings(self):
         return {
             "settings": {
-                "refresh_interval": "10s",
+                "refresh_interval": self.refresh_interval,
                 "default_field": "_id",
                 "analysis": {
                     "analyzer": {
@@ -120,9 +167,33 @@ class ESSetup(object):
         time_settings = self._default_settings()
         time_settings["template"] = "time_*"
         time_settings["settings"]["number_of_shards"] = 1
-        time_settings["settings"]["number_of_replicas"] = 1
+        time_settings["settings"]["number_of_replicas"] = \
+            self.number_of_replicas
         self.client.create_template("time_1", time_settings)
 
+    def start_bulk_load(self, name):
+        """Create an index if needed, and disable its refresh and its
+        replicas until :meth:`end_bulk_load` is called.
+        """
+        try:
+            self.client.create_index(name)
+        except IndexAlreadyExistsError:
+            pass
+        self.client.update_settings(name, {"index": {
+            "refresh_interval": "-1",
+            "number_of_replicas": 0,
+        }})
+
+    def end_bulk_load(self, names):
+        """Restore the template refresh and replicas settings of the
+        indexes, and refresh them.
+        """
+        self.client.update_settings(names, {"index": {
+            "refresh_interval": self.refresh_interval,
+            "number_of_replicas": self.number_of_replicas,
+        }})
+        self.client.refresh(names)
+
     def optimize_index(self, name):
         """Fully optimize an index down to one segment.
         """
@@ -135,56 +206,181 @@ class ESWrite(Plugin):
     def __init__(self, **options):
         self.options = options
         self.url = options['url']
+        # limits of a single bulk request
+        self.bulk_size = int(options.get('bulk_size', 1000))
+        self.bulk_bytes = int(options.get('bulk_bytes', 10 * 1024 * 1024))
+        # number of bulk requests sent at once
+        self.concurrency = int(options.get('concurrency', 1))
+        # disable refresh and replicas of the indexes during a phase
+        self.bulk_load = asbool(options.get('bulk_load', False))
+        self.optimize = asbool(options.get('optimize', False))
+        # retries of the documents rejected by an overloaded cluster
+        self.retries = int(options.get('retries', 3))
+        self.retry_delay = float(options.get('retry_delay', 1.0))
+        self._loading = None
+        self._index_names = {}
         self.client = ExtendedClient(self.url)
+        # keep enough connections alive for all concurrent requests
+        adapter = HTTPAdapter(pool_maxsize=self.concurrency)
+        self.client.session.mount('http://', adapter)
+        self.client.session.mount('https://', adapter)
         self.setup = ESSetup(self.client)
         self.setup.configure_templates()
 
     def _index_name(self, date):
-        return 'time_%.4d-%.2d' % (date.year, date.month)
-
-    def _bulk_index(self, index, doc_type, docs, id_field='id'):
-        # an optimized version of the bulk_index, avoiding
-        # repetition of index and doc_type in each action line
+        key = date.year, date.month
+        try:
+            return self._index_names[key]
+        except KeyError:
+            name = self._index_names[key] = 'time_%.4d-%.2d' % key
+            return name
+
+    def _bulk_bodies(self, docs):
+        """Yields the bulk request bodies for the documents, along with
+        the number of documents they hold.
+
+        A body holds at most *bulk_size* documents and *bulk_bytes*
+        bytes, unless a single document is bigger than that. Each body
+        is written in its own buffer.
+        """
         _encode_json = self.client._encode_json
-        body_bits = []
+        body = StringIO()
+        count = 0
+
         for doc in docs:
-            _id = doc.pop(id_field)
-            action = {'index': {'_id': _id}}
-            body_bits.extend([_encode_json(action), _encode_json(doc)])
+            # the documents are left untouched, their _id and _type
+            # only go in the action line and the url
+            source = dict(doc)
+            del source['_id'], source['_type']
+            lines = (ACTION_LINE % _encode_json(doc['_id']) +
+                     _encode_json(source) + '\n')
+
+            if count > 0 and (count >= self.bulk_size or
+                              body.tell() + len(lines) > self.bulk_bytes):
+                yield body.getvalue(), count
+                body = StringIO()
+                count = 0
+
+            body.write(lines)
+            count += 1
+
+        if count > 0:
+            yield body.getvalue(), count
+
+    def _bulk_requests(self, holder):
+        """Yields an (index, doc_type, body, docs) tuple for every bulk
+        request needed to index the documents of each bucket.
+        """
+        for (index, doc_type), docs in holder.items():
+            start = 0
+            for body, count in self._bulk_bodies(docs):
+                yield index, doc_type, body, docs[start:start + count]
+                start += count
 
-        # Need the trailing newline.
-        body = '\n'.join(body_bits) + '\n'
-        return self.client.send_request('POST',
-                                        [index, doc_type, '_bulk'],
-                                        body,
-                                        encode_body=False)
+    def _bulk_index(self, request):
+        # an optimized version of the bulk_index, avoiding
+        # repetition of index and doc_type in each action line
+        index, doc_type, body, docs = request
+        result = self.client.send_request('POST',
+                                          [index, doc_type, '_bulk'],
+                                          body,
+                                          encode_body=False)
+        return index, doc_type, docs, result['items']
+
+    def _submit(self, holder):
+        """Sends the documents of all index/type buckets, up to
+        *concurrency* requests at once.
+
+        Returns the buckets of the documents rejected with a retryable
+        error, and the last of these errors. Any other error raises a
+        ValueError.
+        """
+        rejected = defaultdict(list)
+        last_error = None
+        pool = Pool(self.concurrency)
+        try:
+            for index, doc_type, docs, items in pool.imap(
+                    self._bulk_index, self._bulk_requests(holder)):
+                for doc, item in izip(docs, items):
+                    item = item['index']
+                    if item.get('ok'):
+                        continue
+                    error = item.get('error')
+                    if error is None:
+                        continue
+                    if not _retryable(item):
+                        raise ValueError(_index_error(doc, error))
+                    rejected[(index, doc_type)].append(doc)
+                    last_error = doc, error
+        finally:
+            pool.kill()
+        return rejected, last_error
 
     def inject(self, batch):
         holder = defaultdict(list)
         # sort data into index/type buckets
         for source_id, item in batch:
             # XXX use source_id as a key with dates for updates
-            item = dict(item)
-            date = item['date']
-            index = self._index_name(date)
-            _type = item.pop('_type')
-            holder[(index, _type)].append(item)
-
-        # submit one bulk request per index/type combination
-        for key, docs in holder.items():
-            result = self._bulk_index(key[0], key[1], docs, id_field='_id')
-            for index, item in enumerate(result['items']):
-                if item['index'].get('ok'):
-                    continue
-                error = item['index'].get('error')
-                if error is not None:
-                    msg = 'Could not index %s' % str(docs[index])
-                    msg += '\nES Error:\n'
-                    msg += error
-                    msg += '\n The data may have been partially imported.'
-                    raise ValueError(msg)
+            index = self._index_name(item['date'])
+            holder[(index, item['_type'])].append(item)
+
+        if self._loading is not None:
+            for index, _type in holder:
+                if index not in self._loading:
+                    self.setup.start_bulk_load(index)
+                    self._loading.add(index)
+
+        # only send the rejected documents again, backing off between
+        # each try to let the cluster catch up
+        tries = 0
+        while holder:
+            holder, last_error = self._submit(holder)
+            if not holder:
+                break
+            tries += 1
+            if tries > self.retries:
+                raise ValueError(_index_error(*last_error))
+            delay = self.retry_delay * 2 ** (tries - 1)
+            count = sum(len(docs) for docs in holder.values())
+            logger.warning('ES rejected %d documents, retrying in %.1fs'
+                           % (count, delay))
+            gevent.sleep(delay)
+
+    def start_transaction(self):
+        if self.bulk_load:
+            self._loading = set()
+
+    def _end_bulk_load(self):
+        indexes, self._loading = self._loading, None
+        if indexes:
+            self.setup.end_bulk_load(sorted(indexes))
+        return indexes
+
+    def commit_transaction(self):
+        indexes = self._end_bulk_load()
+        if indexes and self.optimize:
+            for index in sorted(indexes):
+                self.setup.optimize_index(index)
+
+    def rollback_transaction(self):
+        self._end_bulk_load()
+
+    def _only_holds(self, index, source_ids):
+        """Returns True if all the documents of the index come from
+        one of the sources.
+        """
+        query = {'filtered': {
+            'query': {'match_all': {}},
+            'filter': {
+                'not': {'terms': {
+                    'source_id': source_ids,
+                    '_cache': False,
+                }},
+            },
+        }}
+        return self.client.count(query, index=index)['count'] == 0
 
-    def clear(self, start_date, end_date, source_ids):
+    def _clear_index(self, index, start_date, end_date, source_ids):
         start_date_str = start_date.strftime('%Y-%m-%d')
         end_date_str = end_date.strftime('%Y-%m-%d')
 
@@ -206,5 +402,24 @@ class ESWrite(Plugin):
                 ]
             }
         }}
-        self.client.refresh('time_*')
-        self.client.delete_by_query('time_*', None, query)
+        self.client.delete_by_query(index, None, query)
+
+    def clear(self, start_date, end_date, source_ids):
+        # only touch the monthly indexes covering the range, and drop
+        # the ones being entirely rebuilt rather than deleting their
+        # documents one by one
+        for first, last in split_date_range(start_date, end_date):
+            index = self._index_name(first)
+            last_day = monthrange(first.year, first.month)[1]
+            whole_month = first.day == 1 and last.day == last_day
+            try:
+                # the recent documents of other sources have to be
+                # visible before checking what the index holds
+                self.client.refresh(index)
+                if whole_month and self._only_holds(index, source_ids):
+                    self.client.delete_index(index)
+                else:
+                    self._clear_index(index, first, last, source_ids)
+            except ElasticHttpNotFoundError:
+                # nothing was ever written for this month
+                continue
@@ -1,5 +1,5 @@
-from aggregator.plugins import Plugin
-from aggregator.util import json_dumps
+from monolith.aggregator.plugins import Plugin
+from monolith.aggregator.util import json_dumps
 
 
 class FileWriter(Plugin):
@@ -6,21 +6,21 @@ from oauth2client.client import OAuth2Credentials
 import httplib2
 import gevent
 
-from monolith.aggregator import __version__
+from monolith.aggregator import __version__, httppool
 from monolith.aggregator.plugins import Plugin
 from monolith.aggregator.util import json_loads, date_range
 
 
 SOURCE_APP_NAME = 'monolith-aggregator-v%s' % __version__
+_CREDENTIALS = ('access_token', 'client_id', 'client_secret',
+                'refresh_token', 'token_expiry', 'token_uri', 'user_agent')
 
 
 def get_service(**options):
-    creds = OAuth2Credentials(
-        *[options[k] for k in
-          ('access_token', 'client_id', 'client_secret',
-           'refresh_token', 'token_expiry', 'token_uri',
-           'user_agent')])
-    h = httplib2.Http()
+    creds = OAuth2Credentials(*[options[k] for k in _CREDENTIALS])
+    # one connection per plugin, kept alive between its queries. They
+    # are not shared, as greenlets can't use the same one at once
+    h = httplib2.Http(timeout=httppool.get_timeout())
     creds.authorize(h)
     return build('analytics', 'v3', http=h)
 
@@ -53,6 +53,7 @@ class GoogleAnalytics(Plugin):
         else:
             self.dimensions = ['ga:date']
             self.qdimensions = 'ga:date'
+        self.fields = [self._fix_name(name) for name in self.dimensions]
         if 'rate_limit' in options:
             self.rate_limit = int(options['rate_limit'])
         else:
@@ -104,7 +105,8 @@ class GoogleAnalytics(Plugin):
 
             cols = [col['name'] for col in results['columnHeaders']]
             for entry in results['rows']:
-                data = {'_date': current, '_type': 'visitors'}
+                data = {'_date': current, '_type': 'visitors',
+                        '_dimensions': self.fields}
 
                 for index, value in enumerate(entry):
                     field = self._fix_name(cols[index])
@@ -1,8 +1,10 @@
-import datetime
 import re
 
-import requests
+from gevent.pool import Pool
+
+from monolith.aggregator import httppool
 from monolith.aggregator.plugins import Plugin
+from monolith.aggregator.util import date_range
 
 
 class FileReader(Plugin):
@@ -17,17 +19,30 @@ class FileReader(Plugin):
         self._filename_format = options['filename_format']
         self._data_format = re.compile(options['data_format'])
         self._type = options['type']
+        self._session = httppool.get_session()
+        # number of daily files downloaded at once
+        self._concurrency = int(options.get('concurrency', 1))
+
+    def _fetch(self, date):
+        url = self._baseurl + date.strftime(self._filename_format)
+        resp = self._session.get(url, auth=self._auth)
+        if resp.status_code == 200:
+            return date, resp.content
+        return date, None
 
     def extract(self, start_date, end_date):
-        date = start_date
-        while date <= end_date:
-            url = self._baseurl + date.strftime(self._filename_format)
-            resp = requests.get(url, auth=self._auth)
-            if resp.status_code == 200:
-                for item in self._parse_data(resp.content, date):
-                    yield item
-
-            date += datetime.timedelta(days=1)
+        # the days are downloaded concurrently, but parsed in order. No
+        # more than *concurrency* files wait for the engine to read them
+        pool = Pool(self._concurrency)
+        days = date_range(start_date, end_date)
+        try:
+            for date, content in pool.imap(self._fetch, days,
+                                           maxsize=self._concurrency):
+                if content is not None:
+                    for item in self._parse_data(content, date):
+                        yield item
+        finally:
+            pool.kill()
 
     def _parse_data(self, content, date):
         def _get_item(data):
@@ -5,13 +5,13 @@ from monolith.aggregator.plugins.utils import iso2datetime, TastypieReader
 class SolitudeReader(TastypieReader):
 
     def __init__(self, parser, **options):
-        self.options = options
+        super(SolitudeReader, self).__init__(**options)
         self.endpoint = options['endpoint']
         self.type = options['type']
 
     def extract(self, start_date, end_date):
         end_date = end_date + timedelta(days=1)
-        items = self.read_api(self.endpoint, {
+        items = self.iter_api(self.endpoint, {
             'key': self.type,
             'recorded__gte': start_date.isoformat(),
             'recorded__lte': end_date.isoformat()})
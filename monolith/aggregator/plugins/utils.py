@@ -2,14 +2,15 @@
 import os
 import hashlib
 
+from collections import defaultdict
 from ConfigParser import ConfigParser
 from datetime import datetime
 from urlparse import parse_qsl, urlparse
 
-from requests import Session
+from gevent.pool import Pool
 from requests_oauthlib import OAuth1Session
 
-from monolith.aggregator import logger
+from monolith.aggregator import httppool, logger
 from monolith.aggregator.plugins import Plugin
 from monolith.aggregator.exception import ServerError
 
@@ -26,6 +27,8 @@ class TastypieReader(Plugin):
     def __init__(self, **options):
         super(TastypieReader, self).__init__(**options)
         self.session = self._get_session(**options)
+        # number of pages fetched at once, when the API gives the total
+        self.concurrency = int(options.get('concurrency', 1))
 
     def _get_session(self, **kwargs):
         if 'password-file' in kwargs:
@@ -42,9 +45,10 @@ class TastypieReader(Plugin):
                 key = hashlib.sha512(password + username + 'key')
                 secret = hashlib.sha512(password + username + 'secret')
 
-                return OAuth1Session(key.hexdigest(), secret.hexdigest())
+                return httppool.mount(OAuth1Session(key.hexdigest(),
+                                                    secret.hexdigest()))
         else:
-            return Session()
+            return httppool.get_session()
 
     def delete(self, url, params):
         return self.session.delete(url, params=params)
@@ -54,40 +58,100 @@ class TastypieReader(Plugin):
 
         :param url: Url to read from.
         :param params: List of params to pass in the querystring (filters).
-        :param data: Used to handle recursive calls. The data being retrieved.
+        :param data: The list the objects are appended to.
 
         """
         if data is None:
             data = []
+        data.extend(self.iter_api(url, params))
+        return data
+
+    def _get_page(self, url, params):
+        """Returns the decoded page, or None on a 4xx error."""
+        resp = self.session.get(url, params=params)
+
+        if 400 <= resp.status_code <= 499:
+            logger.error('API 4xx Error: %s Url: %s' %
+                         (resp.json()['reason'], url))
+            return None
+
+        if 500 <= resp.status_code <= 599:
+            logger.error('API 5xx Error: %s Url: %s' % (resp.text, url))
+            raise ServerError(resp.status_code)
+
+        return resp.json()
+
+    def _iter_pages(self, url, params, meta):
+        """Fetches the pages following the one described by *meta*, up to
+        *concurrency* at once, and yields them in order.
+        """
+        limit = int(meta['limit'])
+        first = int(meta.get('offset') or 0) + limit
+
+        def _get_page(offset):
+            page_params = params.copy()
+            page_params.update({'limit': limit, 'offset': offset})
+            return self._get_page(url, page_params)
+
+        # no more than *concurrency* pages wait to be read
+        pool = Pool(self.concurrency)
+        offsets = xrange(first, meta['total_count'], limit)
+        try:
+            for res in pool.imap(_get_page, offsets,
+                                 maxsize=self.concurrency):
+                if res is None:
+                    return
+                yield res
+        finally:
+            pool.kill()
+
+    def iter_api(self, url, params=None):
+        """Reads an API and yields its objects page by page, following
+        pagination. The next page is only requested once the objects of
+        the current one are consumed.
+
+        When *concurrency* is over 1 and the API returns the total count
+        of objects, the offsets of the next pages are computed, and the
+        pages are fetched several at once. Objects still come out in
+        order.
+
+        :param url: Url to read from.
+        :param params: List of params to pass in the querystring (filters).
+
+        """
         if not params:
             params = {}
 
         orig_params = params.copy()
 
         while True:
-            resp = self.session.get(url, params=params)
+            res = self._get_page(url, params)
+            if res is None:
+                return
 
-            if 400 <= resp.status_code <= 499:
-                logger.error('API 4xx Error: %s Url: %s' %
-                             (resp.json()['reason'], url))
-                return data
-
-            if 500 <= resp.status_code <= 599:
-                logger.error('API 5xx Error: %s Url: %s' % (resp.text, url))
-                raise ServerError(resp.status_code)
-
-            res = resp.json()
-            data.extend(res['objects'])
+            for obj in res['objects']:
+                yield obj
 
             # we can have paginated elements, so we need to get them all
-            next_ = None
-            if 'meta' in res:
-                next_ = res['meta'].get('next')
+            meta = res.get('meta', {})
+            next_ = meta.get('next')
+
+            if next_ and self.concurrency > 1 and meta.get('limit') and \
+                    meta.get('total_count') is not None:
+                for res in self._iter_pages(url, orig_params, meta):
+                    for obj in res['objects']:
+                        yield obj
+                return
 
             if next_:
                 # Update the params to pick up the new offset.
                 params = orig_params.copy()
                 qs = urlparse(next_).query
-                params.update(dict(parse_qsl(qs)))
+                # repeated params, like several order_by, stay lists
+                next_params = defaultdict(list)
+                for key, value in parse_qsl(qs):
+                    next_params[key].append(value)
+                for key, values in next_params.items():
+                    params[key] = values[0] if len(values) == 1 else values
             else:
-                return data
+                return
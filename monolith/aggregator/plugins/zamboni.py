@@ -1,5 +1,10 @@
 from datetime import timedelta, date
 from monolith.aggregator.plugins.utils import iso2datetime, TastypieReader
+from monolith.aggregator.util import asbool
+
+
+# stands for a dimension an item doesn't have, in the aggregation keys
+_MISSING = object()
 
 
 class APIReader(TastypieReader):
@@ -17,6 +22,11 @@ class APIReader(TastypieReader):
         self.updatable_fields = [field.strip() for field in
                                  options.get('updatable_fields',
                                              '').split(',')]
+        # the API is asked to sort the items by date, then by id so
+        # the pages don't overlap, and each day can be yielded as soon
+        # as the next one starts. Turn it off for an API which can't
+        # sort them
+        self.ordered = asbool(options.get('ordered', True))
 
     def purge(self, start_date, end_date):
         if self.options.get('purge_data', False):
@@ -47,40 +57,52 @@ class APIReader(TastypieReader):
     def extract(self, start_date, end_date):
         end_date = end_date + timedelta(days=1)
 
-        data = self.read_api(self.endpoint, {
-            'key': self.type,
-            'limit': self.limit,
-            'recorded__gte': start_date.isoformat(),
-            'recorded__lte': end_date.isoformat()})
+        params = {'key': self.type,
+                  'limit': self.limit,
+                  'recorded__gte': start_date.isoformat(),
+                  'recorded__lte': end_date.isoformat()}
+        if self.ordered:
+            params['order_by'] = ['recorded', 'id']
+        data = self.iter_api(self.endpoint, params)
 
         # building counts grouped by date & dimensions
         results = {}
+        dimensions = self.dimensions
+        days = {}
+        current = None
 
         for item in data:
-            timestamp = iso2datetime(item['recorded'])
-            day = date(timestamp.year, timestamp.month, timestamp.day)
+            recorded = item['recorded']
+            # only parse each day once
+            day = days.get(recorded[:10])
+            if day is None:
+                timestamp = iso2datetime(recorded)
+                day = date(timestamp.year, timestamp.month, timestamp.day)
+                days[recorded[:10]] = day
+
+            if self.ordered and day != current:
+                # the previous day is complete
+                for line in results.itervalues():
+                    yield line
+                results = {}
+                current = day
 
             values = item.pop('value')
-            values['_date'] = day
-            key = [('_date', day)]
-
-            for dimension in self.dimensions:
-                if dimension in values:
-                    key.append((dimension, values[dimension]))
-
-            key.sort()
-            key = tuple(key)
+            key = (day,) + tuple(values.get(dimension, _MISSING)
+                                 for dimension in dimensions)
 
             count = values.get('count', 1)
 
             if key not in results:
+                values['_date'] = day
+                values['_dimensions'] = dimensions
+                values['_type'] = self.type
+                values[self.field] = count
                 results[key] = values
-                results[key]['_type'] = self.type
-                results[key][self.field] = count
             else:
                 self._update_fields(results[key], values)
                 results[key][self.field] += count
 
         # rendering the result
-        for line in results.values():
+        for line in results.itervalues():
             yield line
@@ -4,7 +4,9 @@ import tempfile
 
 from unittest2 import TestCase
 
-from monolith.aggregator.db import Database, Record
+from monolith.aggregator.db import Database, Record, Transaction
+from monolith.aggregator.plugins import Plugin
+from monolith.aggregator.util import json_loads
 
 
 class TestDatabase(TestCase):
@@ -53,3 +55,148 @@ class TestDatabase(TestCase):
         self.assertEqual(removed, 2)
         removed = self.db.clear(self._yesterday, self._today, ['s1', 's2'])
         self.assertEqual(removed, 3)
+
+    def test_inject_batch(self):
+        self.db.inject([])
+        self.db.inject([
+            ('s1', dict(_type='foo', key=str(i), _date=self._today))
+            for i in range(50)
+        ])
+        query = self.db.session.query(Record)
+        self.assertEqual(query.count(), 50)
+        self.assertEqual(len(set([record.id for record in query])), 50)
+        values = sorted(int(json_loads(record.value)['key'])
+                        for record in query)
+        self.assertEqual(values, range(50))
+
+    def test_extract_chunks(self):
+        self.db.chunk_size = 10
+        self.db.inject([
+            ('s1', dict(_type='foo', key=str(i),
+                        _date=self._today - datetime.timedelta(days=i % 3)))
+            for i in range(25)
+        ])
+        lines = list(self.db.extract(self._last_week, self._today))
+        self.assertEqual(len(lines), 25)
+        self.assertEqual(len(set([line['_id'] for line in lines])), 25)
+        keys = [(line['date'], line['_id']) for line in lines]
+        self.assertEqual(keys, sorted(keys))
+
+        lines = list(self.db.extract(self._today, self._today))
+        self.assertEqual(len(lines), 9)
+
+    def test_get_done(self):
+        s1, s2, s3 = [Plugin(id=id_) for id_ in ('s1', 's2', 's3')]
+        self.db.add_entry([s1, s2], self._last_week, self._yesterday)
+        self.db.add_entry([s1], self._today)
+
+        done = self.db.get_done([s1, s2, s3], self._yesterday, self._today)
+        self.assertEqual(done, set([('s1', self._yesterday),
+                                    ('s1', self._today),
+                                    ('s2', self._yesterday)]))
+        self.assertEqual(self.db.get_done([], self._last_week, self._today),
+                         set())
+
+        self.assertTrue(self.db.exists(s2, self._last_week, self._today))
+        self.assertFalse(self.db.exists(s2, self._today, self._today))
+        self.assertFalse(self.db.exists(s3, self._last_week, self._today))
+
+    def test_add_entry(self):
+        s1, s2 = Plugin(id='s1'), Plugin(id='s2')
+        self.db.add_entry([s1, s2], self._last_week, self._today)
+        query = self.db.session.query(Transaction)
+        self.assertEqual(query.count(), 16)
+
+        # duplicates are ignored
+        self.db.add_entry([s1], self._yesterday, self._today)
+        self.db.add_entry([s2], self._today)
+        self.assertEqual(query.count(), 16)
+        self.db.add_entry([], self._today)
+
+    def test_inject_datetimes(self):
+        from monolith.aggregator import db
+        calls = []
+        urlsafe_uids = db.urlsafe_uids
+
+        def _urlsafe_uids(count, _date=None):
+            calls.append(_date)
+            return urlsafe_uids(count, _date)
+
+        db.urlsafe_uids = _urlsafe_uids
+        try:
+            self.db.inject([
+                ('test', dict(_type='foo', _date=datetime.datetime(
+                    2013, 1, 1, hour), count=hour)) for hour in range(10)])
+        finally:
+            db.urlsafe_uids = urlsafe_uids
+
+        # a single batch of ids for the day
+        self.assertEqual(calls, [datetime.date(2013, 1, 1)])
+        self.assertEqual(self.db.session.query(Record).count(), 10)
+
+    def test_inject_content_uid(self):
+        db = Database(database=self.sqluri, uid='content')
+
+        def _inject(count, **dims):
+            item = dict(_type='foo', _date=self._today, count=count,
+                        _dimensions=['app'], **dims)
+            db.inject([('s1', item)])
+
+        _inject(1, app=1)
+        _inject(2, app=1)
+        _inject(3, app=2)
+
+        query = db.session.query(Record).order_by(Record.value)
+        values = [json_loads(record.value) for record in query]
+        # the first record was overwritten in place
+        self.assertEqual(values, [{'app': 1, 'count': 2},
+                                  {'app': 2, 'count': 3}])
+
+        # same content, same ids
+        ids = [record.id for record in query]
+        _inject(2, app=1)
+        self.assertEqual([record.id for record in query], ids)
+
+        self.assertRaises(ValueError, Database, database=self.sqluri,
+                          uid='foo')
+
+    def test_inject_content_uid_missing_dimension(self):
+        db = Database(database=self.sqluri, uid='content')
+        # no region, and a region set to None, are two different lines
+        db.inject([
+            ('s1', dict(_type='foo', _date=self._today, _dimensions=['app',
+                        'region'], app=1, count=1)),
+            ('s1', dict(_type='foo', _date=self._today, _dimensions=['app',
+                        'region'], app=1, region=None, count=2)),
+        ])
+        self.assertEqual(db.session.query(Record).count(), 2)
+
+    def test_inject_content_uid_no_dimensions(self):
+        db = Database(database=self.sqluri, uid='content')
+        item = dict(_type='foo', _date=self._today, app=1, count=1)
+        # lines without dimensions get random ids, and are never merged
+        db.inject([('s1', item), ('s1', item)])
+        db.inject([('s1', item)])
+        ids = [record.id for record in db.session.query(Record)]
+        self.assertEqual(len(set(ids)), 3)
+
+    def test_inject_compress(self):
+        # a row written before compression was turned on
+        self.db.inject([('s1', dict(_type='foo', _date=self._today,
+                                    count=1))])
+        db = Database(database=self.sqluri, compress='zlib')
+        db.inject([('s1', dict(_type='foo', _date=self._today, count=2))])
+
+        values = [str(record.value) for record in
+                  db.session.query(Record).order_by(Record.value)]
+        self.assertTrue(values[0].startswith('\x01'))
+        self.assertTrue(values[1].startswith('{'))
+
+        # both rows read back, whatever the current setting
+        for reader in (db, self.db):
+            counts = [data['count'] for data in
+                      reader.extract(self._today, self._today)]
+            self.assertEqual(sorted(counts), [1, 2])
+
+        self.assertRaises(ValueError, Database, database=self.sqluri,
+                          compress='foo')
@@ -0,0 +1,172 @@
+import datetime
+import os
+import tempfile
+
+import gevent
+from unittest2 import TestCase
+
+from monolith.aggregator.db import Database
+from monolith.aggregator.engine import Engine
+from monolith.aggregator.exception import RunError
+from monolith.aggregator.plugins import Plugin
+
+
+TODAY = datetime.date.today()
+
+
+class Source(Plugin):
+
+    def __init__(self, **options):
+        super(Source, self).__init__(**options)
+        self.calls = []
+
+    def extract(self, start_date, end_date):
+        self.calls.append((start_date, end_date))
+        for i in range(int(self.options.get('count', 50))):
+            yield {'_type': 'test', '_date': TODAY, 'index': i}
+
+
+class SlowSource(Plugin):
+
+    def extract(self, start_date, end_date):
+        for i in range(3):
+            yield {'_type': 'test', '_date': TODAY, 'index': i}
+            gevent.sleep(0.1)
+
+
+class Target(Plugin):
+
+    def __init__(self, **options):
+        super(Target, self).__init__(**options)
+        self.batches = []
+        self.writing = self.max_writing = 0
+
+    def inject(self, batch):
+        self.writing += 1
+        self.max_writing = max(self.writing, self.max_writing)
+        gevent.sleep(float(self.options.get('delay', 0)))
+        self.batches.append(batch)
+        self.writing -= 1
+
+
+class FailingTarget(Target):
+
+    def inject(self, batch):
+        super(FailingTarget, self).inject(batch)
+        raise ValueError('boom')
+
+
+class TestEngine(TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+        self.db = Database(database='sqlite:///%s' % self.filename)
+
+    def tearDown(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def _run(self, sources, targets, start_date=TODAY, end_date=TODAY,
+             **options):
+        sequence = [('extract', sources, targets)]
+        engine = Engine(sequence, self.db, **options)
+        engine.run(start_date, end_date)
+        return engine
+
+    def test_bounded_queue(self):
+        target = Target(id='target')
+        engine = self._run([Source(id='source', count=200)], [target],
+                           queue_size=5)
+        items = [item for batch in target.batches for item in batch]
+        self.assertEqual(len(items), 200)
+        self.assertTrue(engine.stats['queue_hwm'] <= 5)
+        self.assertTrue(engine.stats['queue_full'] > 0)
+
+    def test_max_latency(self):
+        target = Target(id='target')
+        self._run([SlowSource(id='source')], [target], max_latency=0.01)
+        # partial batches are pushed when the source is slow
+        self.assertEqual([len(batch) for batch in target.batches], [1, 1, 1])
+
+    def test_full_batches(self):
+        target = Target(id='target')
+        self._run([Source(id='source', count=250)], [target], batch_size=100)
+        self.assertEqual([len(batch) for batch in target.batches],
+                         [100, 100, 50])
+
+    def test_inflight(self):
+        target = Target(id='target', delay=0.01)
+        self._run([Source(id='source')], [target], batch_size=10)
+        self.assertEqual(target.max_writing, 1)
+        self.assertEqual(len(target.batches), 5)
+
+        # the target section can allow more batches at once
+        target = Target(id='target', delay=0.01, inflight=3)
+        self._run([Source(id='source')], [target], batch_size=10, force=True)
+        self.assertEqual(target.max_writing, 3)
+        self.assertEqual(len(target.batches), 5)
+
+    def test_max_inflight(self):
+        class SerialTarget(Target):
+            max_inflight = 1
+
+        # the global inflight doesn't apply to targets writing one
+        # batch at a time, like the sql one
+        target = SerialTarget(id='target', delay=0.01)
+        self._run([Source(id='source')], [target], batch_size=10,
+                  inflight=3)
+        self.assertEqual(target.max_writing, 1)
+        self.assertEqual(len(target.batches), 5)
+        self.assertEqual(Database.max_inflight, 1)
+
+    def test_inject_error(self):
+        target = FailingTarget(id='target', delay=0.01, inflight=2)
+        sequence = [('extract', [Source(id='source')], [target])]
+        engine = Engine(sequence, self.db, batch_size=10, retries=1)
+        self.assertRaises(RunError, engine.run, TODAY, TODAY)
+        # the days of a failed phase are not logged
+        source = sequence[0][1][0]
+        self.assertEqual(list(self.db.get_done([source], TODAY, TODAY)), [])
+
+    def test_transactions_logged_by_phase(self):
+        callers = []
+
+        class _Database(Database):
+            def add_entry(self, *args, **kw):
+                callers.append(gevent.getcurrent())
+                return super(_Database, self).add_entry(*args, **kw)
+
+        self.db = _Database(database='sqlite:///%s' % self.filename)
+        sources = [SlowSource(id='source%d' % i) for i in range(3)]
+        self._run(sources, [Target(id='target')])
+        # the shared session is never used from the source greenlets
+        self.assertEqual(callers, [gevent.getcurrent()] * 3)
+        self.assertEqual(len(list(self.db.get_done(sources, TODAY, TODAY))),
+                         3)
+
+    def test_batches_across_sources(self):
+        target = Target(id='target')
+        sources = [Source(id='source%d' % i, count=15) for i in range(4)]
+        engine = self._run(sources, [target])
+        # the end of a source doesn't cut the batch short
+        self.assertEqual([len(batch) for batch in target.batches], [60])
+        self.assertEqual(dict(engine.stats['batches']), {64: 1})
+
+    def test_missing_days(self):
+        def _d(days):
+            return TODAY - datetime.timedelta(days=days)
+
+        source = Source(id='source', count=1)
+        self.db.add_entry([source], _d(8), _d(6))
+        self.db.add_entry([source], _d(3))
+
+        self._run([source], [Target(id='target')], _d(9), _d(1))
+        # only the missing days are extracted
+        self.assertEqual(source.calls, [(_d(9), _d(9)), (_d(5), _d(4)),
+                                        (_d(2), _d(1))])
+
+        # now everything is done
+        source.calls = []
+        self._run([source], [Target(id='target')], _d(9), _d(1))
+        self.assertEqual(source.calls, [])
@@ -66,9 +66,9 @@ class TestESSetup(IsolatedTestCase):
 
 class TestESWrite(IsolatedTestCase):
 
-    def _make_one(self):
+    def _make_one(self, **options):
         from monolith.aggregator.plugins import es
-        options = {'url': self.es_cluster.urls}
+        options['url'] = self.es_cluster.urls
         return es.ESWrite(**options)
 
     def test_constructor(self):
@@ -93,6 +93,146 @@ class TestESWrite(IsolatedTestCase):
             self.assertEqual(source[field], data[1][field])
         self.assertEqual(source['date'], '2012-07-04T00:00:00')
 
+    def test_call_chunks(self):
+        plugin = self._make_one(bulk_size=3, bulk_bytes=1024)
+        data = [('sql', {
+            '_id': 'abc%d' % i,
+            '_type': 'downloads',
+            'date': datetime.datetime(2012, 7, 4),
+            'source_id': 'zamboni',
+            'foo': 'bar' * i,
+        }) for i in range(100)]
+        plugin.inject(data)
+        self.es_client.refresh()
+        res = self.es_client.count({'match_all': {}})
+        self.assertEqual(res['count'], 100)
+
+    def test_call_concurrency(self):
+        plugin = self._make_one(bulk_size=2, concurrency=4)
+        data = [('sql', {
+            '_id': 'abc%d' % i,
+            '_type': 'downloads',
+            'date': datetime.datetime(2012, i % 6 + 1, 4),
+            'source_id': 'zamboni',
+        }) for i in range(30)]
+        plugin.inject(data)
+        self.es_client.refresh()
+        res = self.es_client.count({'match_all': {}})
+        self.assertEqual(res['count'], 30)
+
+    def test_bulk_load(self):
+        plugin = self._make_one(bulk_load='true', optimize='true')
+        plugin.start_transaction()
+        plugin.inject([('sql', {
+            '_id': 'abc123',
+            '_type': 'downloads',
+            'date': datetime.datetime(2012, 7, 4),
+            'source_id': 'zamboni',
+        })])
+        settings = self.es_client.get_settings('time_2012-07')
+        settings = settings['time_2012-07']['settings']
+        self.assertEqual(settings['index.refresh_interval'], '-1')
+        self.assertEqual(settings['index.number_of_replicas'], '0')
+
+        plugin.commit_transaction()
+        settings = self.es_client.get_settings('time_2012-07')
+        settings = settings['time_2012-07']['settings']
+        self.assertEqual(settings['index.refresh_interval'], '10s')
+        self.assertEqual(settings['index.number_of_replicas'], '1')
+        # the index was refreshed
+        res = self.es_client.count({'match_all': {}}, index='time_2012-07')
+        self.assertEqual(res['count'], 1)
+
+    def test_call_retry_rejected(self):
+        plugin = self._make_one(retry_delay=0.01)
+        send_request = plugin.client.send_request
+        calls = []
+
+        def _send_request(*args, **kw):
+            # the first request gets its last item rejected
+            result = send_request(*args, **kw)
+            calls.append(len(result['items']))
+            if len(calls) == 1:
+                result['items'][-1]['index'] = {
+                    'error': 'EsRejectedExecutionException[rejected]'}
+            return result
+
+        plugin.client.send_request = _send_request
+        data = [('sql', {
+            '_id': 'abc%d' % i,
+            '_type': 'downloads',
+            'date': datetime.datetime(2012, 7, 4),
+            'source_id': 'zamboni',
+        }) for i in range(5)]
+        plugin.inject(data)
+        # only the rejected document was sent again
+        self.assertEqual(calls, [5, 1])
+
+    def test_call_retry_exhausted(self):
+        plugin = self._make_one(retries=2, retry_delay=0.01)
+        calls = []
+
+        def _send_request(method, path, body, **kw):
+            calls.append(path)
+            return {'items': [{'index': {'status': 429, 'error': 'busy'}}]}
+
+        plugin.client.send_request = _send_request
+        data = ('sql', {
+            '_id': 'abc123',
+            '_type': 'downloads',
+            'date': datetime.datetime(2012, 7, 4),
+        })
+        self.assertRaises(ValueError, plugin.inject, [data])
+        self.assertEqual(len(calls), 3)
+
+    def _inject_days(self, plugin, source_id, days, refresh=True):
+        plugin.inject([('sql', {
+            '_id': '%s%s' % (source_id, day.isoformat()),
+            '_type': 'downloads',
+            'date': day,
+            'source_id': source_id,
+        }) for day in days])
+        if refresh:
+            self.es_client.refresh()
+
+    def test_clear(self):
+        plugin = self._make_one()
+        july = [datetime.datetime(2012, 7, day) for day in (1, 15, 31)]
+        august = [datetime.datetime(2012, 8, day) for day in (1, 15, 31)]
+        self._inject_days(plugin, 'zamboni', july + august)
+        self._inject_days(plugin, 'ga', august)
+
+        plugin.clear(datetime.date(2012, 7, 1), datetime.date(2012, 8, 20),
+                     ['zamboni'])
+        self.es_client.refresh()
+        # the july index only held cleared documents and was dropped
+        indexes = self.es_client.status()['indices']
+        self.assertFalse('time_2012-07' in indexes)
+        # august is still there, with the documents out of the range
+        # or from other sources
+        res = self.es_client.count({'match_all': {}}, index='time_2012-08')
+        self.assertEqual(res['count'], 4)
+
+        # clearing months without any index is fine
+        plugin.clear(datetime.date(2011, 1, 1), datetime.date(2011, 2, 1),
+                     ['zamboni'])
+
+    def test_clear_unrefreshed(self):
+        plugin = self._make_one(bulk_load='true')
+        july = [datetime.datetime(2012, 7, day) for day in (1, 15, 31)]
+        self._inject_days(plugin, 'zamboni', july)
+        # another run writes without refreshing the index
+        plugin.start_transaction()
+        self._inject_days(plugin, 'ga', july[:1], refresh=False)
+
+        plugin.clear(datetime.date(2012, 7, 1), datetime.date(2012, 7, 31),
+                     ['zamboni'])
+        self.es_client.refresh()
+        # the document of the other source was seen, and kept
+        res = self.es_client.count({'match_all': {}}, index='time_2012-07')
+        self.assertEqual(res['count'], 1)
+        plugin.commit_transaction()
+
     def test_call_bad_data(self):
         plugin = self._make_one()
 
@@ -0,0 +1,102 @@
+# extract runs only using sqlite and in-process plugins
+import datetime
+import os
+import shutil
+import tempfile
+
+from unittest2 import TestCase
+
+from monolith.aggregator import extract as extract_module
+from monolith.aggregator.db import Database, Transaction
+from monolith.aggregator.extract import extract
+from monolith.aggregator.plugins import extract as extract_plugin
+
+
+DAY = datetime.date(2013, 1, 1)
+SECOND_DAY = DAY + datetime.timedelta(days=1)
+
+
+@extract_plugin
+def fails_on_second_day(start_date, end_date, **options):
+    if start_date <= SECOND_DAY <= end_date:
+        raise ValueError('boom')
+    yield {'_type': 'fails', '_date': start_date}
+
+
+class _Engine(object):
+    # records the options the engine is built with
+    options = None
+
+    def __init__(self, sequence, database, **options):
+        _Engine.options = options
+
+    def run(self, start_date, end_date, purge_only=False):
+        return 0
+
+
+class TestExtractLocal(TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.temp_dir, 'monolith.db')
+        self.config = self._make_config('config_local.ini')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _make_config(self, base_name):
+        here = os.path.dirname(__file__)
+        with open(os.path.join(here, base_name)) as base:
+            config_text = base.read().format(
+                db_path=self.db_path,
+                records_path=os.path.join(self.temp_dir, 'records.db'))
+        config = os.path.join(self.temp_dir, base_name)
+        with open(config, 'w') as f:
+            f.write(config_text)
+        return config
+
+    def _engine_options(self, **options):
+        old_engine = extract_module.Engine
+        extract_module.Engine = _Engine
+        try:
+            extract(self.config, DAY, DAY, **options)
+        finally:
+            extract_module.Engine = old_engine
+        return _Engine.options
+
+    def test_config_options(self):
+        options = self._engine_options()
+        self.assertEqual(options['batch_size'], 50)
+        self.assertEqual(options['queue_size'], 5)
+        self.assertEqual(options['max_latency'], 2.5)
+        self.assertEqual(options['inflight'], 2)
+        self.assertEqual(options['clear'], False)
+
+    def test_arguments_win(self):
+        options = self._engine_options(batch_size=20, queue_size=10,
+                                       max_latency=0.5, inflight=3,
+                                       clear=True)
+        self.assertEqual(options['batch_size'], 20)
+        self.assertEqual(options['queue_size'], 10)
+        self.assertEqual(options['max_latency'], 0.5)
+        self.assertEqual(options['inflight'], 3)
+        self.assertEqual(options['clear'], True)
+
+    def _done(self, source):
+        database = Database(database='sqlite:///' + self.db_path)
+        query = database.session.query(Transaction)
+        query = query.filter(Transaction.source == source)
+        return sorted(entry.date for entry in query)
+
+    def test_shards(self):
+        res = extract(self.config, DAY, SECOND_DAY, workers=2, shard='day')
+        self.assertEqual(res, 0)
+        # each worker logged its day
+        self.assertEqual(self._done('source:random'), [DAY, SECOND_DAY])
+
+    def test_shards_failure(self):
+        res = extract(self.config, DAY, SECOND_DAY, sequence='fails',
+                      workers=2, shard='day', retries=1)
+        self.assertEqual(res, 1)
+        # the other shard still went through
+        self.assertEqual(self._done('source:fails'), [DAY])
@@ -0,0 +1,37 @@
+from unittest2 import TestCase
+
+from requests import Session
+
+from monolith.aggregator import httppool
+
+
+class TestHTTPPool(TestCase):
+
+    def tearDown(self):
+        httppool.configure(pool_size=10, timeout=60.)
+
+    def test_shared_session(self):
+        session = httppool.get_session()
+        self.assertTrue(session is httppool.get_session())
+        adapter = httppool.get_adapter()
+        self.assertTrue(session.adapters['http://'] is adapter)
+        self.assertTrue(session.adapters['https://'] is adapter)
+
+    def test_mount(self):
+        session = httppool.mount(Session())
+        self.assertTrue(session.adapters['https://'] is
+                        httppool.get_adapter())
+        self.assertFalse(session is httppool.get_session())
+
+    def test_configure(self):
+        session = httppool.get_session()
+        httppool.configure(pool_size=3, timeout=5.)
+        self.assertFalse(session is httppool.get_session())
+        adapter = httppool.get_adapter()
+        self.assertEqual(adapter.timeout, 5.)
+        self.assertEqual(adapter._pool_maxsize, 3)
+        self.assertEqual(httppool.get_timeout(), 5.)
+
+        # unset values are left alone
+        httppool.configure(pool_size=4)
+        self.assertEqual(httppool.get_timeout(), 5.)
@@ -0,0 +1,73 @@
+from ConfigParser import ConfigParser
+from datetime import date
+from unittest2 import TestCase
+
+import gevent
+
+from monolith.aggregator.plugins.metrics import FileReader
+
+
+class _Response(object):
+
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+
+
+class _Session(object):
+    """Serves the later days faster than the earlier ones."""
+
+    def __init__(self):
+        self.running = self.max_running = self.calls = 0
+
+    def get(self, url, auth=None):
+        day = int(url[-2:])
+        self.calls += 1
+        self.running += 1
+        self.max_running = max(self.running, self.max_running)
+        gevent.sleep(0.01 * max(10 - day, 0))
+        self.running -= 1
+        if day == 3:
+            return _Response('', status_code=404)
+        return _Response('visits=%d\n' % (day * 10))
+
+
+class TestFileReader(TestCase):
+
+    def _make_one(self, **options):
+        parser = ConfigParser()
+        parser.add_section('metrics')
+        parser.set('metrics', 'username', 'user')
+        parser.set('metrics', 'password', 'pass')
+        parser.set('metrics', 'url', 'http://example.com/')
+        reader = FileReader(parser, filename_format='%Y-%m-%d',
+                            data_format=r'visits=(?P<visits>\d+)',
+                            type='visits', **options)
+        reader._session = _Session()
+        return reader
+
+    def _extract(self, reader):
+        items = reader.extract(date(2013, 1, 1), date(2013, 1, 5))
+        return [(item['_date'].day, item['visits']) for item in items]
+
+    def test_extract(self):
+        reader = self._make_one()
+        self.assertEqual(self._extract(reader),
+                         [(1, '10'), (2, '20'), (4, '40'), (5, '50')])
+        self.assertEqual(reader._session.max_running, 1)
+
+    def test_extract_concurrency(self):
+        reader = self._make_one(concurrency='5')
+        # still in date order
+        self.assertEqual(self._extract(reader),
+                         [(1, '10'), (2, '20'), (4, '40'), (5, '50')])
+        self.assertEqual(reader._session.max_running, 5)
+
+    def test_extract_bounded(self):
+        reader = self._make_one(concurrency='2')
+        items = reader.extract(date(2013, 1, 1), date(2013, 1, 31))
+        items.next()
+        # a slow consumer doesn't get the whole month downloaded
+        gevent.sleep(0.2)
+        self.assertTrue(reader._session.calls <= 5)
+        self.assertEqual(len(list(items)), 29)
@@ -0,0 +1,42 @@
+from base64 import urlsafe_b64decode
+from datetime import date
+
+from unittest2 import TestCase
+
+from monolith.aggregator.uid import content_uid, urlsafe_uid, urlsafe_uids
+
+
+class TestUID(TestCase):
+
+    def test_urlsafe_uid(self):
+        uid = urlsafe_uid(date(2013, 4, 1))
+        self.assertEqual(len(uid), 24)
+        self.assertEqual(len(urlsafe_b64decode(uid)), 16)
+        self.assertNotEqual(uid, urlsafe_uid(date(2013, 4, 1)))
+
+    def test_urlsafe_uids(self):
+        uids = urlsafe_uids(1000, date(2013, 4, 1))
+        self.assertEqual(len(uids), 1000)
+        self.assertEqual(len(set(uids)), 1000)
+
+        raw = [urlsafe_b64decode(uid) for uid in uids]
+        # same node and date prefix as the single version
+        single = urlsafe_b64decode(urlsafe_uid(date(2013, 4, 1)))
+        self.assertEqual(raw[0][:8], single[:8])
+        # ordered by time
+        self.assertEqual([uid[:14] for uid in raw],
+                         sorted([uid[:14] for uid in raw]))
+
+        self.assertEqual(urlsafe_uids(0), [])
+
+    def test_content_uid(self):
+        uid = content_uid(date(2013, 4, 1), 'source', 'type', [('a', 1)])
+        self.assertEqual(len(uid), 24)
+        self.assertEqual(uid, content_uid(date(2013, 4, 1), 'source',
+                                          'type', [('a', 1)]))
+        self.assertNotEqual(uid, content_uid(date(2013, 4, 1), 'source',
+                                             'type', [('a', 2)]))
+        # ids of the same day share a prefix
+        self.assertEqual(uid[:5], content_uid(date(2013, 4, 1), 'other')[:5])
+        self.assertNotEqual(uid[:5], content_uid(date(2013, 4, 2),
+                                                 'source')[:5])
@@ -2,7 +2,9 @@ from unittest2 import TestCase
 from datetime import date, datetime, timedelta
 
 from monolith.aggregator.util import word2daterange, date_range
+from monolith.aggregator.util import split_date_range, missing_date_ranges
 from monolith.aggregator.util import json_loads, json_dumps
+from monolith.aggregator.util import asbool
 
 
 class TestUtils(TestCase):
@@ -45,6 +47,44 @@ class TestUtils(TestCase):
         self.assertEqual(list(date_range(yesterday, now)), [yesterday, now])
         self.assertEqual(list(date_range(yesterday, yesterday)), [yesterday])
 
+    def test_split_date_range(self):
+        start, end = date(2012, 12, 30), date(2013, 2, 2)
+
+        res = split_date_range(start, end, 'month')
+        self.assertEqual(res, [(start, date(2012, 12, 31)),
+                               (date(2013, 1, 1), date(2013, 1, 31)),
+                               (date(2013, 2, 1), end)])
+
+        res = split_date_range(start, end, 'day')
+        self.assertEqual(len(res), 35)
+        self.assertEqual(res[0], (start, start))
+        self.assertEqual(res[-1], (end, end))
+
+        self.assertEqual(split_date_range(end, end), [(end, end)])
+        self.assertRaises(NotImplementedError, split_date_range, start, end,
+                          'year')
+
+    def test_missing_date_ranges(self):
+        start, end = date(2013, 1, 1), date(2013, 1, 10)
+
+        def _d(day):
+            return date(2013, 1, day)
+
+        self.assertEqual(missing_date_ranges(start, end, set()),
+                         [(start, end)])
+        self.assertEqual(missing_date_ranges(start, end, set(date_range(
+            start, end))), [])
+
+        done = set([_d(1), _d(4), _d(5), _d(9)])
+        self.assertEqual(missing_date_ranges(start, end, done),
+                         [(_d(2), _d(3)), (_d(6), _d(8)), (_d(10), _d(10))])
+
+    def test_asbool(self):
+        for value in ('true', 'Yes', ' on ', '1', True, 1):
+            self.assertTrue(asbool(value))
+        for value in ('false', 'no', 'off', '0', '', False, 0, None):
+            self.assertFalse(asbool(value))
+
 
 class TestJSON(TestCase):
 
@@ -56,6 +96,17 @@ class TestJSON(TestCase):
         data = json_dumps({'date': datetime(2012, 3, 15, 13, 55, 10)})
         self.assertEqual(data, '{"date": "2012-03-15T13:55:10.000000"}')
 
+    def test_dumps_datetime_microseconds(self):
+        data = json_dumps({'date': datetime(2012, 3, 15, 13, 55, 10, 42)})
+        self.assertEqual(data, '{"date": "2012-03-15T13:55:10.000042"}')
+
+    def test_codec_options(self):
+        from monolith.aggregator.util import JSONCodec
+        codec = JSONCodec(default=None, sort_keys=True)
+        self.assertEqual(codec.encode({'b': 1, 'a': 2}), '{"a": 2, "b": 1}')
+        self.assertRaises(TypeError, codec.encode, {'date': date.today()})
+        self.assertEqual(codec.decode('[1]'), [1])
+
     def test_dumps_error(self):
         self.assertRaises(TypeError, json_dumps, {'foo': object()})
 
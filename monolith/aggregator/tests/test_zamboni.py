@@ -4,6 +4,9 @@ from datetime import datetime, timedelta
 from itertools import islice
 from unittest2 import TestCase
 
+import gevent
+
+from monolith.aggregator.exception import ServerError
 from monolith.aggregator.util import json_dumps
 from monolith.aggregator.plugins.zamboni import APIReader
 
@@ -89,6 +92,42 @@ def _mock_fetch_uris(endpoint, resource_uri):
         rest_data = list(rest)
 
 
+class _Response(object):
+
+    def __init__(self, data, status_code=200):
+        self.data = data
+        self.status_code = status_code
+        self.text = json_dumps(data)
+
+    def json(self):
+        return self.data
+
+
+class _Session(object):
+    """Serves pages of 2 objects, out of *count*."""
+
+    def __init__(self, count, status_code=200, query=''):
+        self.count = count
+        self.status_code = status_code
+        self.query = query
+        self.calls = []
+
+    def get(self, url, params=None):
+        self.calls.append(dict(params))
+        if self.status_code != 200:
+            return _Response({'reason': 'Bad'}, self.status_code)
+        offset = int(params.get('offset', 0))
+        next_ = None
+        if offset + 2 < self.count:
+            next_ = '/api/?limit=2&offset=%d%s' % (offset + 2, self.query)
+        objects = range(offset, min(offset + 2, self.count))
+        return _Response({'meta': {'next': next_,
+                                   'limit': 2,
+                                   'offset': offset,
+                                   'total_count': self.count},
+                          'objects': objects})
+
+
 class TestAPIReader(TestCase):
 
     def setUp(self, *args, **kwargs):
@@ -107,12 +146,127 @@ class TestAPIReader(TestCase):
                            type='install', field='foo')
         self.assertEqual(reader.get_id(), 'mkt-install-foo')
 
+    def test_iter_api(self):
+        reader = APIReader(endpoint='http://' + self.endpoint, type='install',
+                           field='foo')
+        reader.session = _Session(5)
+        objects = reader.iter_api(reader.endpoint, {'key': 'install'})
+
+        # the pages are requested as the objects are consumed
+        self.assertEqual(list(islice(objects, 2)), [0, 1])
+        self.assertEqual(len(reader.session.calls), 1)
+        self.assertEqual(list(objects), [2, 3, 4])
+        self.assertEqual(len(reader.session.calls), 3)
+        self.assertEqual(reader.session.calls[-1],
+                         {'key': 'install', 'limit': '2', 'offset': '4'})
+
+        # read_api still returns a list
+        self.assertEqual(reader.read_api(reader.endpoint), range(5))
+
+    def test_iter_api_repeated_params(self):
+        reader = APIReader(endpoint='http://' + self.endpoint, type='install',
+                           field='foo')
+        reader.session = _Session(5, query='&order_by=recorded&order_by=id')
+        objects = list(reader.iter_api(reader.endpoint,
+                                       {'order_by': ['recorded', 'id']}))
+        self.assertEqual(objects, range(5))
+        # the next pages keep every sort key
+        for call in reader.session.calls:
+            self.assertEqual(call['order_by'], ['recorded', 'id'])
+
+    def test_iter_api_concurrency(self):
+        reader = APIReader(endpoint='http://' + self.endpoint, type='install',
+                           field='foo', concurrency='3')
+        reader.session = _Session(9)
+        objects = list(reader.iter_api(reader.endpoint, {'key': 'install'}))
+        self.assertEqual(objects, range(9))
+        # the offsets were computed from the total count
+        offsets = [call.get('offset') for call in reader.session.calls]
+        self.assertEqual(offsets, [None, 2, 4, 6, 8])
+        self.assertEqual(reader.session.calls[-1],
+                         {'key': 'install', 'limit': 2, 'offset': 8})
+
+        reader.session = _Session(5, status_code=503)
+        self.assertRaises(ServerError, list, reader.iter_api(reader.endpoint))
+
+    def test_iter_api_concurrency_bounded(self):
+        reader = APIReader(endpoint='http://' + self.endpoint, type='install',
+                           field='foo', concurrency='2')
+        reader.session = _Session(2000)
+        objects = reader.iter_api(reader.endpoint, {'key': 'install'})
+        self.assertEqual(list(islice(objects, 4)), range(4))
+        # a slow reader doesn't get all the pages buffered
+        gevent.sleep(0.1)
+        self.assertTrue(len(reader.session.calls) <= 6)
+        self.assertEqual(len(list(objects)), 1996)
+
+    def test_iter_api_errors(self):
+        reader = APIReader(endpoint='http://' + self.endpoint, type='install',
+                           field='foo')
+        reader.session = _Session(5, status_code=404)
+        self.assertEqual(list(reader.iter_api(reader.endpoint)), [])
+        reader.session = _Session(5, status_code=503)
+        self.assertRaises(ServerError, list, reader.iter_api(reader.endpoint))
+
+    def _extract(self, items, **options):
+        reader = APIReader(endpoint='http://' + self.endpoint, type='install',
+                           field='installs', dimensions='app-id, region',
+                           **options)
+        consumed = []
+        self.params = None
+
+        def _iter_api(url, params):
+            self.params = params
+            for item in items:
+                consumed.append(item)
+                yield item
+
+        reader.iter_api = _iter_api
+        return reader.extract(self.last_week, self.yesterday), consumed
+
+    def _items(self):
+        return [{'recorded': '2013-02-0%dT10:00:00' % day,
+                 'value': {'app-id': app_id, 'region': region}}
+                for day, app_id, region in ((5, 1, 'us'), (5, 1, 'us'),
+                                            (5, 2, 'us'), (5, 1, None),
+                                            (6, 1, 'us'), (7, 1, 'fr'))]
+
+    def test_extract_aggregates(self):
+        lines, _ = self._extract(self._items(), ordered='false')
+        lines = sorted((line['_date'].day, line['app-id'],
+                        line.get('region'), line['installs'])
+                       for line in lines)
+        self.assertEqual(lines, [(5, 1, None, 1), (5, 1, 'us', 2),
+                                 (5, 2, 'us', 1), (6, 1, 'us', 1),
+                                 (7, 1, 'fr', 1)])
+        self.assertFalse('order_by' in self.params)
+
+    def test_extract_ordered(self):
+        lines, consumed = self._extract(self._items())
+        first = lines.next()
+        # the id breaks the ties, so the pages don't overlap
+        self.assertEqual(self.params['order_by'], ['recorded', 'id'])
+        self.assertEqual(first['_date'].day, 5)
+        # the lines of the first day come out as soon as the next day
+        # starts
+        self.assertEqual(len(consumed), 5)
+        self.assertEqual(len(list(lines)), 4)
+
+    def test_extract_unordered(self):
+        reader = APIReader(endpoint='http://' + self.endpoint, type='install',
+                           field='foo', ordered='false')
+        reader.iter_api = lambda url, params: iter(_get_raw_values())
+        # the shuffled items still make one line per day and user-agent
+        values = list(reader.extract(self.last_week, self.yesterday))
+        self.assertEquals(len(values), 20)
+
     @httprettified
     def test_rest_endpoint_is_called(self):
         _mock_fetch_uris(self.endpoint, self.resource_uri)
 
+        # the mocked API doesn't sort the items
         reader = APIReader(endpoint='http://' + self.endpoint, type='install',
-                           field='foo')
+                           field='foo', ordered='false')
         values = list(reader.extract(self.last_week, self.yesterday))
 
         # If we get back 20 values, it means that all the data had been read
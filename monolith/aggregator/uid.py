@@ -1,29 +1,32 @@
 from base64 import urlsafe_b64encode
 from calendar import timegm
 from datetime import date, datetime
+from hashlib import sha1
 import random
+import struct
 import uuid
 
+from monolith.aggregator.util import json_dumps
+
 
 _randrange = random.Random().randrange
 _node = uuid.getnode()
+_pack = struct.Struct('>QQ').pack
+_pack_day = struct.Struct('>I').pack
+_LOW = 0xffffffffffffffffL
 
 
-def urlsafe_uid(_date=None):
-    """
-    A simplified version of uuid1 - optimized for usage as a
-    MySQL primary key and ElasticSearch id.
-    """
-    if _date is None:
-        _date = date.today()
+def _timestamp(_date):
     # take the passed in date, and add the current time to it
     # that way we preserve the right coarse-grained date, but also
     # make duplicates less likely by having a non-constant time part
     now = datetime.utcnow()
     timestamp = timegm(_date.timetuple()[:3] + now.timetuple()[3:])
     timestamp = int((timestamp * 1e6) + now.microsecond)
-    timestamp = (timestamp * 10) + 0x01b21dd213814000L
+    return (timestamp * 10) + 0x01b21dd213814000L
+
 
+def _uid(timestamp):
     time_low = timestamp & 0xffffffffL  # changes every 100 nano-seconds
     time_mid = (timestamp >> 32L) & 0xffffL  # changes every ~15 minutes
     time_hi = (timestamp >> 48L) & 0x0fffL  # changes every ~3 years
@@ -34,8 +37,38 @@ def urlsafe_uid(_date=None):
     int_ = ((_node << 80L) | (time_hi << 64L) | (time_mid << 48L) |
             (time_low << 16L) | clock_seq)
 
-    bytes = ''
-    for shift in range(0, 128, 8):
-        bytes = chr((int_ >> shift) & 0xff) + bytes
+    return urlsafe_b64encode(_pack(int_ >> 64L, int_ & _LOW))
 
-    return urlsafe_b64encode(bytes)
+
+def urlsafe_uid(_date=None):
+    """
+    A simplified version of uuid1 - optimized for usage as a
+    MySQL primary key and ElasticSearch id.
+    """
+    if _date is None:
+        _date = date.today()
+    return _uid(_timestamp(_date))
+
+
+def urlsafe_uids(count, _date=None):
+    """Returns a list of *count* ids for the given date.
+
+    The current time is read once, and each id gets the next 100
+    nano-seconds tick, so the ids keep the ordering of
+    :func:`urlsafe_uid`.
+    """
+    if _date is None:
+        _date = date.today()
+    timestamp = _timestamp(_date)
+    return [_uid(timestamp + tick) for tick in xrange(count)]
+
+
+def content_uid(_date, *parts):
+    """Returns an id derived from the date and the given parts.
+
+    The same date and parts always give the same id. The parts are
+    JSON-encoded values, and the id starts with the day so records
+    of the same day stay close in BTree inserts.
+    """
+    digest = sha1(json_dumps((_date,) + parts)).digest()
+    return urlsafe_b64encode(_pack_day(_date.toordinal()) + digest[:12])
@@ -4,26 +4,62 @@ import fcntl
 import logging
 
 
-try:
-    import simplejson as json       # NOQA
-except ImportError:
-    import json                     # NOQA
+def _fastest_json():
+    """Returns simplejson when its C speedups are built, and the
+    standard library json module otherwise.
+    """
+    try:
+        import simplejson
+    except ImportError:
+        pass
+    else:
+        if simplejson.encoder.c_make_encoder is not None:
+            return simplejson
+    import json
+    return json
+
+
+json = _fastest_json()
 
 
 def encode_date(obj):
     if isinstance(obj, datetime):
+        if obj.tzinfo is None:
+            # isoformat is a lot faster than strftime, but leaves the
+            # microseconds out when there are none
+            if obj.microsecond:
+                return obj.isoformat()
+            return obj.isoformat() + '.000000'
         return obj.strftime('%Y-%m-%dT%H:%M:%S.%f')
     elif isinstance(obj, date):
-        return obj.strftime('%Y-%m-%d')
+        return obj.isoformat()
     raise TypeError(repr(obj) + " is not JSON serializable")
 
 
+class JSONCodec(object):
+    """Encodes and decodes JSON with encoder and decoder instances
+    built once, instead of on every call.
+
+    *encoder* is the encoder class, built with the other options.
+    """
+    def __init__(self, encoder=None, default=encode_date, **options):
+        if encoder is None:
+            encoder = json.JSONEncoder
+        if default is not None:
+            options['default'] = default
+        self.encode = encoder(**options).encode
+        self.decode = json.JSONDecoder().decode
+
+
+codec = JSONCodec()
+
+
 def json_loads(obj):
-    return json.loads(obj)
+    return codec.decode(obj)
 
 
 def json_dumps(obj):
-    return json.dumps(obj, default=encode_date)
+    return codec.encode(obj)
 
 
 LOG_LEVELS = {
@@ -37,6 +73,13 @@ LOG_FMT = r"%(asctime)s [%(process)d] [%(levelname)s] %(message)s"
 LOG_DATE_FMT = r"%Y-%m-%d %H:%M:%S"
 
 
+def asbool(value):
+    """Converts a configuration value like "true" or "off" to a bool."""
+    if isinstance(value, basestring):
+        return value.strip().lower() in ('true', 'yes', 'on', '1')
+    return bool(value)
+
+
 def close_on_exec(fd):
     flags = fcntl.fcntl(fd, fcntl.F_GETFD)
     flags |= fcntl.FD_CLOEXEC
@@ -105,3 +148,47 @@ def date_range(start, end):
     """
     delta = (end - start).days + 1
     return (start + timedelta(n) for n in range(delta))
+
+
+def split_date_range(start, end, shard='month'):
+    """Splits a range of dates in a list of smaller ranges.
+
+    *shard* is either **day** or **month**. The first and last ranges
+    are clipped to *start* and *end*.
+    """
+    if shard not in ('day', 'month'):
+        raise NotImplementedError(shard)
+
+    ranges = []
+    current = start
+    while current <= end:
+        if shard == 'day':
+            last = current
+        else:
+            last_day = monthrange(current.year, current.month)[1]
+            last = date(current.year, current.month, last_day)
+        last = min(last, end)
+        ranges.append((current, last))
+        current = last + timedelta(days=1)
+    return ranges
+
+
+def missing_date_ranges(start, end, dates):
+    """Returns the list of ranges of dates between start and end that
+    are not in *dates*.
+
+    Each range is a (first, last) tuple of consecutive missing dates.
+    """
+    ranges = []
+    first = None
+    for current in date_range(start, end):
+        if current in dates:
+            if first is not None:
+                ranges.append((first, current - timedelta(days=1)))
+                first = None
+        elif first is None:
+            first = current
+
+    if first is not None:
+        ranges.append((first, end))
+    return ranges
@@ -0,0 +1,56 @@
+"""
+Micro-benchmark of the JSON encoding of typical zamboni records.
+
+Compares a plain json.dumps call with a date callback, as done before
+the codec was introduced, with monolith.aggregator.util.json_dumps.
+
+Run: python tools/bench_json.py [number of records]
+"""
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+from monolith.aggregator import util
+
+
+def _records(count):
+    start = datetime(2013, 1, 1)
+    return [{'_type': 'install',
+             'app-id': 1234 + i % 50,
+             'anonymous': i % 3 == 0,
+             'installs': 1,
+             'user-agent': 'Mozilla/5.0 (Mobile; rv:18.0) Firefox/18.0',
+             'locale': 'en-US',
+             'date': start + timedelta(minutes=i)}
+            for i in range(count)]
+
+
+def _old_encode_date(obj):
+    if isinstance(obj, datetime):
+        return obj.strftime('%Y-%m-%dT%H:%M:%S.%f')
+    return obj.strftime('%Y-%m-%d')
+
+
+def main(count=10000):
+    records = _records(count)
+    json = util.json
+
+    def old():
+        for record in records:
+            json.dumps(record, default=_old_encode_date)
+
+    def new():
+        for record in records:
+            util.json_dumps(record)
+
+    print('Encoding %d records with %s' % (count, json.__name__))
+    results = {}
+    for name, func in (('json.dumps', old), ('util.json_dumps', new)):
+        results[name] = min(timeit.repeat(func, number=1, repeat=5))
+        print('%-16s %.3fs' % (name, results[name]))
+    print('Speedup: %.2fx' % (results['json.dumps'] /
+                              results['util.json_dumps']))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])